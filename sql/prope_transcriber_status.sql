@@ -0,0 +1,27 @@
+-- Returns the number of files in "propE_transcriber" together with their file_ids,
+-- so the transcriber gets both from a single RPC call. When known_count (the count
+-- of the transcriber's local file_id cache) still matches, "ids" is null and the
+-- cached ids are reused instead of sending every id again.
+create or replace function prope_transcriber_status(known_count integer default null)
+returns jsonb
+language sql
+stable
+as $$
+  with status as (
+    select count(*)::integer as file_count
+    from "propE_transcriber"
+    where file_id is not null
+  )
+  select jsonb_build_object(
+    'count', status.file_count,
+    'ids', case
+      when status.file_count = known_count then null
+      else (
+        select coalesce(jsonb_agg(file_id), '[]'::jsonb)
+        from "propE_transcriber"
+        where file_id is not null
+      )
+    end
+  )
+  from status;
+$$;
@@ -1,11 +1,15 @@
 import os
-import requests
-import json
+import asyncio
+import httpx
+import orjson
 import logging
-from io import BytesIO
+import functools
+import tempfile
+import shutil
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from openai import OpenAI
+from supabase import create_async_client, AsyncClient
+from openai import AsyncOpenAI, APIError
+from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
@@ -26,22 +30,177 @@ if not all([SUPABASE_URL, SUPABASE_KEY, OPENAI_API_KEY, PROPEQUITY_API_BASE_URL,
     logging.error("One or more required environment variables are not set. Please check your .env file.")
     exit(1) # Exit if essential variables are missing
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# Built once per process and shared by every task; caching keeps retries and
+# error paths from re-creating them. The async Supabase client can only be built
+# inside the event loop, so it is cached by hand instead of with lru_cache.
+_supabase_client = None
+
+async def get_supabase_client() -> AsyncClient:
+    global _supabase_client
+    if _supabase_client is None:
+        _supabase_client = await create_async_client(SUPABASE_URL, SUPABASE_KEY)
+    return _supabase_client
+
+@functools.lru_cache(maxsize=1)
+def get_openai_client() -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=OPENAI_API_KEY)
 
 # --- Constants ---
 MAX_FILE_COUNT = 53 
 SUPABASE_TABLE_NAME = "propE_transcriber"
 SUPABASE_STORAGE_BUCKET = "prope.transcriberaudio"
+SUPABASE_STATUS_FUNCTION = "prope_transcriber_status" # Defined in sql/prope_transcriber_status.sql
+TRANSCRIBER_CONCURRENCY = int(os.getenv("TRANSCRIBER_CONCURRENCY", "8")) # Recordings processed concurrently
+DEFAULT_AUDIO_EXTENSION = "mp3"
+AUDIO_MIME_TYPES = {
+    "mp3": "audio/mpeg",
+    "mpeg": "audio/mpeg",
+    "mpga": "audio/mpeg",
+    "wav": "audio/wav",
+    "mp4": "audio/mp4", # Could be audio/mp4 or video/mp4
+    "m4a": "audio/mp4",
+    "ogg": "audio/ogg",
+    "oga": "audio/ogg",
+    "flac": "audio/flac",
+    "webm": "audio/webm"
+}
+TRANSCRIPTION_CHUNK_SECONDS = 300 # Recordings longer than this are split before transcription
+TRANSCRIPTION_CHUNK_CONCURRENCY = 4 # Chunks of one recording transcribed concurrently
+CALLBACK_CONCURRENCY = 16 # PropEquity callbacks sent concurrently
+FILE_ID_CACHE_PATH = os.getenv("FILE_ID_CACHE_PATH", ".cache/supabase_ids.json")
+
+# --- Call Summary Schema ---
+# Passed to OpenAI as the structured output format, so the prompt no longer has to spell out the JSON.
+class CallSummaryDto(BaseModel):
+    Configuration: str
+    Size_Range: str
+    BSP: str
+    Total_Units: str
+    Units_available: str
+    Completion_Date: str
+    Additional_Notes: str
+    Notes: str
+
+class CallSummary(BaseModel):
+    dto: CallSummaryDto
+
+# --- Prompts ---
+# Built once at import. The static instructions come before the transcript so every
+# request shares the same prompt prefix, which OpenAI can serve from its prompt cache.
+SYSTEM_PROMPT = """You are an expert Indian real estate data analyst and you are well versed with the jargons and technicalities used in real estate transactions. You will be given call transcripts and you will have to provide a call summary along with following data in JSON format."""
+USER_PROMPT_PREFIX = """Analyze this call transcript and fill in every field of the response schema (Configuration, Size_Range, BSP, Total_Units, Units_available, Completion_Date, Additional_Notes, Notes) under "dto":
+
+Rules:
+- If developer says "90% sold" and total is 100 units, then 10 units available
+- Mark as "Successful" even if project is sold out but developer gave information
+- Use "Successful (absorption)" if got price + availability info
+- Calculate BSP by dividing price by carpet area
+- All the responses should be string.
+
+Instructions:
+-"BSP": Calculate per square feet price by by dividing price of the individual configuration by carpet area of the same individual configuration. If there are two or three configuration available in the project then give the average value of the calculation
+
+"Size_Range": The carpet of  the configuration as mentioned in the conversation. If there are two configuration 2 and 3 and they have carpet 750 and 1000 then record response as 750-1000.
+
+"Units_available": Total units available for booking, as per the developer.
+
+"Total_Units": Total units planned in the project.
+
+"Configuration": List BHK types mentioned like "2,3".
+
+"Completion_Date": Mention project completion time or say "Ready to Move" if completed.
+
+"Additional_Notes": Expert summary of the whole transcript. This should include everything that was contained in the call.
+
+"Notes": give response in one word, if the developer asked to call back or asks to connect with someone else by sharing a mobile number, mention as 'Call back', if wrong number was dialled then mention as 'Wrong number' or if the call went to voice mail or any automated answering machine, then mention as 'Voicemail'.if the information regarding the type of configuration, price and area of each configuration, total number of units the project will have and the units still available and/or total number of units sold so far has been provied, record response as 'Successful'.There is an exception for successful calls. If the developer does not give any information and tells the project is sold out or there is no units available for sale, such calls too should be labeled as 'Successful' If  the information of total number of units still available or total number of units sold so far is available  and price of units is available then label them as 'Successful (absorption)', if all the information is available except either the information of total number of units still available for sale or total number of units sold so far, then label them as 'Partial', please be aware that developer might either say 90% sold or 90% available, this means if there are 100 total units the 90% or 90 units are sold or 90 are still available out of 100 for sale.A call should be labelled as 'Unsuccessful' if there is no information available regarding total units that be there in the project, price of unit and  and how many units have been sold so far or are still available. .
+
+Call Transcript: """
+
+# --- HTTP Client ---
+# One pooled HTTP/2 client is shared by every task for the PropEquity API calls.
+# Connections are kept alive, so repeated calls skip the TCP/TLS handshake.
+HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+HTTP_TIMEOUT = httpx.Timeout(60.0) # Per connect/read/write, generous for recording downloads
+HTTP_RETRY_TOTAL = 3
+HTTP_RETRY_BACKOFF = 0.3 # Seconds, doubled on every retry
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+@functools.lru_cache(maxsize=1)
+def get_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(http2=True, limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+async def http_get(url: str) -> httpx.Response:
+    """
+    GETs url with the shared client, retrying connection errors and 429/5xx
+    responses with exponential backoff. Only GETs are retried; POSTs are not
+    idempotent.
+    """
+    http = get_http_client()
+    for attempt in range(HTTP_RETRY_TOTAL + 1):
+        try:
+            response = await http.get(url)
+        except httpx.TransportError:
+            if attempt == HTTP_RETRY_TOTAL:
+                raise
+        else:
+            if response.status_code not in HTTP_RETRY_STATUSES or attempt == HTTP_RETRY_TOTAL:
+                return response
+            await response.aclose()
+        await asyncio.sleep(HTTP_RETRY_BACKOFF * 2 ** attempt)
+
+# --- File ID Cache ---
+def load_file_id_cache():
+    """
+    Returns the cached {"count": ..., "ids": [...]} of Supabase file_ids, or None
+    if there is no usable cache.
+    """
+    try:
+        with open(FILE_ID_CACHE_PATH, "rb") as cache_file:
+            cache = orjson.loads(cache_file.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+    if (
+        not isinstance(cache, dict)
+        or not isinstance(cache.get("count"), int)
+        or not isinstance(cache.get("ids"), list)
+    ):
+        return None
+    return cache
+
+def save_cached_file_ids(file_ids: set):
+    """Writes the Supabase file_ids and their count to the local cache."""
+    try:
+        os.makedirs(os.path.dirname(FILE_ID_CACHE_PATH) or ".", exist_ok=True)
+        with open(FILE_ID_CACHE_PATH, "wb") as cache_file:
+            cache_file.write(orjson.dumps({"count": len(file_ids), "ids": sorted(file_ids)}))
+    except OSError as e:
+        logging.warning(f"Could not write file_id cache to {FILE_ID_CACHE_PATH}: {e}")
+
+def invalidate_file_id_cache():
+    """Deletes the local file_id cache so the next run fetches the ids from Supabase."""
+    try:
+        os.remove(FILE_ID_CACHE_PATH)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.warning(f"Could not delete file_id cache {FILE_ID_CACHE_PATH}: {e}")
 
-def run_transcriber_workflow():
+async def run_transcriber_workflow():
 
     logging.info("Starting PropE_Transcriber workflow...")
+    supabase = await get_supabase_client()
 
     # 1. Get Count from Supabase (getcount & Summarize)
+    # One RPC (sql/prope_transcriber_status.sql) counts the rows in the database and
+    # also returns the existing file_ids, unless the count still matches the local
+    # cache, so the ids for step 4 need no second round trip.
+    file_id_cache = load_file_id_cache()
     try:
-        response = supabase.table(SUPABASE_TABLE_NAME).select("file_id").neq("file_id", "null").execute()
-        current_file_count = len(response.data)
+        response = await supabase.rpc(SUPABASE_STATUS_FUNCTION, {
+            "known_count": file_id_cache["count"] if file_id_cache else None
+        }).execute()
+        supabase_status = response.data
+        current_file_count = supabase_status["count"]
         logging.info(f"Current file count in Supabase: {current_file_count}")
 
         # 2. Conditional Check (If node)
@@ -55,29 +214,35 @@ def run_transcriber_workflow():
     # 3. Get list of recordings from PropEquity API (Get-list)
     try:
         get_list_url = f"{PROPEQUITY_API_BASE_URL}/get-recordings"
-        response = requests.get(get_list_url)
+        response = await http_get(get_list_url)
         response.raise_for_status() # Raise an exception for HTTP errors
         api_recordings = response.json()
         logging.info(f"Fetched {len(api_recordings)} recordings from PropEquity API.")
-    except requests.exceptions.RequestException as e:
+    except (httpx.HTTPError, ValueError) as e:
         logging.error(f"Error fetching recordings from PropEquity API: {e}")
         return
 
     # 4. Get existing file_ids from Supabase
-    try:
-        response = supabase.table(SUPABASE_TABLE_NAME).select("file_id").execute()
-        existing_supabase_file_ids = {item['file_id'] for item in response.data}
+    # The ids are cached on disk together with the count they were read at; while
+    # the count is unchanged the RPC leaves them out and the cached ids are reused.
+    if supabase_status.get("ids") is None:
+        existing_supabase_file_ids = set(file_id_cache["ids"])
+        logging.info(f"Loaded {len(existing_supabase_file_ids)} existing file_ids from the local cache.")
+    else:
+        existing_supabase_file_ids = set(supabase_status["ids"])
         logging.info(f"Fetched {len(existing_supabase_file_ids)} existing file_ids from Supabase.")
-    except Exception as e:
-        logging.error(f"Error fetching existing file_ids from Supabase: {e}")
-        return
+        save_cached_file_ids(existing_supabase_file_ids)
 
     # 5. Compare Datasets to find new recordings
-    new_recordings_to_process = []
+    # Assuming 'fileId' from API matches 'file_id' in Supabase. Indexing by fileId
+    # also drops duplicate API records, keeping the first one in API order.
+    api_recordings_by_id = {}
     for record in api_recordings:
-        # Assuming 'fileId' from API matches 'file_id' in Supabase
-        if record.get('fileId') and record['fileId'] not in existing_supabase_file_ids:
-            new_recordings_to_process.append(record)
+        if record.get('fileId'):
+            api_recordings_by_id.setdefault(record['fileId'], record)
+    new_recordings_to_process = [
+        record for file_id, record in api_recordings_by_id.items() if file_id not in existing_supabase_file_ids
+    ]
     logging.info(f"Found {len(new_recordings_to_process)} new recordings to process.")
 
     if not new_recordings_to_process:
@@ -85,222 +250,365 @@ def run_transcriber_workflow():
         return
 
     # 6. Process each new recording
-    for record_data in new_recordings_to_process:
-        file_id = record_data.get('fileId')
-        project_id = record_data.get('projectID')
-        file_extension = record_data.get('fileExt')
+    # 6.1. Save metadata to Supabase for all new recordings in a single bulk insert
+    # Rows that already exist are skipped rather than failing the whole batch; only
+    # the rows actually inserted come back, and only those recordings are processed.
+    try:
+        response = await supabase.table(SUPABASE_TABLE_NAME).upsert([
+            {
+                "file_id": record['fileId'],
+                "project_id": record.get('projectID'),
+                "file_extension": record.get('fileExt')
+            }
+            for record in new_recordings_to_process
+        ], on_conflict="file_id", ignore_duplicates=True).execute()
+        inserted_file_ids = {row['file_id'] for row in response.data}
+        skipped_file_ids = [record['fileId'] for record in new_recordings_to_process if record['fileId'] not in inserted_file_ids]
+        if skipped_file_ids:
+            logging.warning(f"Skipping recordings already present in Supabase: {skipped_file_ids}")
+        new_recordings_to_process = [record for record in new_recordings_to_process if record['fileId'] in inserted_file_ids]
+        logging.info(f"Metadata saved for {len(new_recordings_to_process)} recordings in Supabase.")
+    except Exception as e:
+        logging.error(f"Error saving metadata to Supabase: {e}")
+        # The cached ids may be what produced the bad batch; drop them so the next
+        # run reads the ids from Supabase instead of repeating the same failure.
+        invalidate_file_id_cache()
+        return
+    if skipped_file_ids:
+        # The cache missed rows that exist in Supabase, so it is stale
+        invalidate_file_id_cache()
+    else:
+        # Keep the cache in step with the rows just inserted so the next run can reuse it
+        save_cached_file_ids(existing_supabase_file_ids | inserted_file_ids)
+
+    # Each recording is dominated by network I/O, so the downloads, uploads and
+    # OpenAI calls of different files run concurrently on the event loop.
+    processed_recordings = await gather_limited(
+        process_recording, new_recordings_to_process, TRANSCRIBER_CONCURRENCY
+    )
+
+    # 6.10. Send data back to PropEquity API (sendback-data-fromDB_direct)
+    # Callbacks are collected during processing and sent together afterwards, so
+    # their round trips overlap instead of each one holding up its recording.
+    pending_callbacks = [pending for pending in processed_recordings if pending]
+    callback_rows = [
+        row for row in await gather_limited(send_recording_callback, pending_callbacks, CALLBACK_CONCURRENCY) if row
+    ]
+
+    # 6.11. Save the callback response for every file in one bulk upsert
+    # (updatewithcallresponse_direct). The rows already exist from 6.1, so only
+    # callback_response is merged into them.
+    if callback_rows:
+        try:
+            await supabase.table(SUPABASE_TABLE_NAME).upsert(callback_rows, on_conflict="file_id").execute()
+            logging.info(f"Updated callback_response for {len(callback_rows)} recordings in Supabase.")
+        except Exception as e:
+            failed_file_ids = [row["file_id"] for row in callback_rows]
+            logging.error(f"Error saving callback results to Supabase for {failed_file_ids}: {e}", exc_info=True)
+
+    logging.info("PropE_Transcriber workflow completed.")
 
-        if not file_id:
-            logging.warning(f"Skipping record due to missing fileId: {record_data}")
-            continue
+async def gather_limited(coroutine_function, items: list, limit: int) -> list:
+    """
+    Runs coroutine_function over items concurrently, at most limit at a time,
+    and returns the results in the order of items.
+    """
+    semaphore = asyncio.Semaphore(limit)
 
-        logging.info(f"Processing file_id: {file_id}")
+    async def run_limited(item):
+        async with semaphore:
+            return await coroutine_function(item)
 
-        try:
-            # 6.1. Save metadata to Supabase
-            supabase.table(SUPABASE_TABLE_NAME).insert({
-                "file_id": file_id,
-                "project_id": project_id,
-                "file_extension": file_extension
-            }).execute()
-            logging.info(f"Metadata saved for {file_id} in Supabase.")
-
-            # 6.2. Get Recording (Get-Recording)
-            get_recording_url = f"{PROPEQUITY_API_BASE_URL}/{file_id}"
-            audio_response = requests.get(get_recording_url, stream=True)
-            audio_response.raise_for_status()
-            audio_content = BytesIO(audio_response.content)
-            logging.info(f"Downloaded audio for {file_id}.")
-
-            # 6.3. Store in Supabase (store-in-supabase)
-            # Determine content type (mimeType) from the downloaded file or assume based on extension
-            # For simplicity, let's assume common audio types or try to infer
-            mime_type = "audio/mpeg" # Default, adjust as needed based on file_extension
-            if file_extension == "wav":
-                mime_type = "audio/wav"
-            elif file_extension == "mp4":
-                mime_type = "audio/mp4" # Could be audio/mp4 or video/mp4
-
-            storage_path = f"{file_id}" # Supabase storage path
-            supabase.storage.from_(SUPABASE_STORAGE_BUCKET).upload(
-                file=audio_content.getvalue(),
-                path=storage_path,
-                file_options={"content-type": mime_type, "x-upsert": "true"}
-            )
-            logging.info(f"Uploaded {file_id} to Supabase storage.")
+    return await asyncio.gather(*(run_limited(item) for item in items))
 
+async def process_recording(record_data: dict):
+    """
+    Runs steps 6.2 - 6.9 for a single recording and returns its pending callback
+    for send_recording_callback. Any failure is routed to handle_processing_error
+    and returns None, so that one bad file never cancels the others.
+    """
+    file_id = record_data['fileId']
+    project_id = record_data.get('projectID')
+    file_extension = record_data.get('fileExt')
+
+    logging.info(f"Processing file_id: {file_id}")
+    supabase = await get_supabase_client()
+    openai_client = get_openai_client()
+
+    try:
+        # 6.2. Get Recording (Get-Recording)
+        # The body is read once; that single bytes object is shared by upload and transcription.
+        get_recording_url = f"{PROPEQUITY_API_BASE_URL}/{file_id}"
+        audio_response = await http_get(get_recording_url)
+        audio_response.raise_for_status()
+        audio_bytes = audio_response.content
+        logging.info(f"Downloaded audio for {file_id}.")
+
+        # 6.3. Store in Supabase (store-in-supabase)
+        # Determine content type (mimeType) from the file extension, defaulting to mp3
+        audio_extension = (file_extension or "").lower().lstrip(".")
+        if audio_extension not in AUDIO_MIME_TYPES:
+            audio_extension = DEFAULT_AUDIO_EXTENSION
+        mime_type = AUDIO_MIME_TYPES[audio_extension]
+
+        storage_path = f"{file_id}" # Supabase storage path
+        await supabase.storage.from_(SUPABASE_STORAGE_BUCKET).upload(
+            file=audio_bytes,
+            path=storage_path,
+            file_options={"content-type": mime_type, "x-upsert": "true"}
+        )
+        logging.info(f"Uploaded {file_id} to Supabase storage.")
+
+        # 6.4 and 6.7 are independent once the upload is done, so the signed URL
+        # request runs while Whisper transcribes the call.
+        signed_url_response, transcript_text = await asyncio.gather(
             # 6.4. Make signed URL token (make-signedURL-token)
             # Supabase storage doesn't directly return a signed URL on upload.
             # We will  generate it separately.
-            signed_url_response = supabase.storage.from_(SUPABASE_STORAGE_BUCKET).create_signed_url(
+            supabase.storage.from_(SUPABASE_STORAGE_BUCKET).create_signed_url(
                 path=storage_path,
                 expires_in=3600 # 1 hour
-            )
-            signed_url = signed_url_response['signedURL']
-            logging.info(f"Generated signed URL for {file_id}.")
-
-            # 6.5. Save call recording URL (save-callrecording-URL)
-            # Let's use the full signed_url directly.
-            supabase.table(SUPABASE_TABLE_NAME ).update({
-                "recording": signed_url
-            }).eq("file_id", file_id).execute()
-            logging.info(f"Updated recording URL for {file_id} in Supabase.")
-
-            # 6.6. Convert file to binary (convertfiletobinary) - already have audio_content
-            # This step is implicitly handled as we have the audio content in BytesIO.
-            # For OpenAI, we need to pass the file-like object or bytes.
+            ),
+            # 6.6. Convert file to binary (convertfiletobinary) - already have audio_bytes
+            # The same immutable bytes object is referenced, not copied, by both requests.
+            # They need real bytes: storage3 and httpx reject a memoryview.
 
             # 6.7. Transcribe Call (transcribe-call)
-            # Reset BytesIO stream to beginning for reading by OpenAI
-            audio_content.seek(0)
-            transcription_response = openai_client.audio.transcriptions.create(
-                model="whisper-1",
-                file=("audio.mp3", audio_content.getvalue(), mime_type), # filename, bytes, mimetype
-                language="en",
-                temperature=0.5
-            )
-            transcript_text = transcription_response.text
-            logging.info(f"Transcribed audio for {file_id}.")
-
-            # 6.8. Summarize Call (summarize-call)
-            system_prompt = """You are an expert Indian real estate data analyst and you are well versed with the jargons and technicalities used in real estate transactions. You will be given call transcripts and you will have to provide a call summary along with following data in JSON format."""
-            user_prompt = f"""Analyze this call transcript and extract the following information in JSON format:
-
-Call Transcript: {transcript_text}
-
-Required JSON Output:
-{{
-  "dto":
-  {{
-"Configuration": "",
-"Size_Range": "",
-"BSP": "",
-"Total_Units": "",
-"Units_available": "",
-"Completion_Date": "",
-"Additional_Notes": "",
-"Notes": ""
-}}
-}}
-
-Rules:
-- If developer says "90% sold" and total is 100 units, then 10 units available
-- Mark as "Successful" even if project is sold out but developer gave information
-- Use "Successful (absorption)" if got price + availability info
-- Calculate BSP by dividing price by carpet area
-- All the responses should be string.
+            transcribe_audio(openai_client, audio_bytes, audio_extension, mime_type)
+        )
+        signed_url = signed_url_response['signedURL']
+        logging.info(f"Generated signed URL and transcribed audio for {file_id}.")
+
+        # 6.8. Summarize Call (summarize-call)
+        user_prompt = USER_PROMPT_PREFIX + transcript_text
+
+        # Structured outputs constrain the reply to the CallSummary schema; a truncated
+        # reply raises LengthFinishReasonError, which goes to the error path below.
+        chat_completion = await openai_client.beta.chat.completions.parse(
+            model="gpt-4o-mini",
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt}
+            ],
+            response_format=CallSummary
+        )
+        summary_message = chat_completion.choices[0].message
+        if summary_message.refusal:
+            raise ValueError(f"OpenAI refused to summarize the call: {summary_message.refusal}")
+        # The content is already a JSON string matching the schema; it is stored and sent back as is.
+        summary_content_str = summary_message.content
+
+        logging.info(f"Summarized call for {file_id}.")
+
+        # 6.5 & 6.9. Save recording URL and transcriptData in one update as soon as the
+        # file is done (save-callrecording-URL & updatewithcallresponse_direct2)
+        await supabase.table(SUPABASE_TABLE_NAME).update({
+            "recording": signed_url, # Let's use the full signed_url directly.
+            "transcriptData": summary_content_str
+        }).eq("file_id", file_id).execute()
+        logging.info(f"Updated recording URL and transcriptData for {file_id} in Supabase.")
 
-Instructions:
--"BSP": Calculate per square feet price by by dividing price of the individual configuration by carpet area of the same individual configuration. If there are two or three configuration available in the project then give the average value of the calculation
+        return {
+            "file_id": file_id,
+            "project_id": project_id,
+            "transcriptData": summary_content_str
+        }
 
-"Size_Range": The carpet of  the configuration as mentioned in the conversation. If there are two configuration 2 and 3 and they have carpet 750 and 1000 then record response as 750-1000.
+    except httpx.HTTPError as e:
+        error_message = f"HTTP Request Error for {file_id}: {e}"
+        logging.error(error_message)
+        # Error reporting path (error reporting & sendback-data-fromDB_direct2)
+        await handle_processing_error(file_id, project_id, error_message)
+    except APIError as e:
+        error_message = f"OpenAI API Error for {file_id}: {e}"
+        logging.error(error_message)
+        await handle_processing_error(file_id, project_id, error_message)
+    except Exception as e:
+        error_message = f"General processing error for {file_id}: {e}"
+        logging.error(error_message, exc_info=True) # Log traceback for general errors
+        await handle_processing_error(file_id, project_id, error_message)
 
-"Units_available": Total units available for booking, as per the developer.
+def write_file(path: str, data: bytes):
+    """Writes bytes to a file; run through asyncio.to_thread to keep the event loop free."""
+    with open(path, "wb") as output_file:
+        output_file.write(data)
 
-"Total_Units": Total units planned in the project.
+async def transcribe_audio(openai_client: AsyncOpenAI, audio_bytes: bytes, audio_extension: str, mime_type: str) -> str:
+    """
+    Transcribes a recording with Whisper. Recordings longer than
+    TRANSCRIPTION_CHUNK_SECONDS are split with ffmpeg and the chunks are
+    transcribed concurrently. Without ffmpeg and ffprobe on PATH the recording is
+    sent in a single request.
+    """
+    if not (shutil.which("ffmpeg") and shutil.which("ffprobe")):
+        return await create_transcription(openai_client, audio_bytes, audio_extension, mime_type)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        source_path = os.path.join(work_dir, f"source.{audio_extension}")
+        await asyncio.to_thread(write_file, source_path, audio_bytes)
+
+        chunk_paths = []
+        duration = await probe_audio_duration(source_path)
+        if duration is not None and duration > TRANSCRIPTION_CHUNK_SECONDS:
+            chunk_paths = await split_audio(source_path, work_dir, audio_extension)
+
+        if len(chunk_paths) <= 1:
+            return await create_transcription(openai_client, audio_bytes, audio_extension, mime_type)
+
+        logging.info(f"Transcribing {duration:.0f}s recording in {len(chunk_paths)} chunks.")
+
+        async def transcribe_chunk(chunk_path: str) -> str:
+            with open(chunk_path, "rb") as chunk_file:
+                return await create_transcription(openai_client, chunk_file, audio_extension, mime_type)
+
+        return " ".join(await gather_limited(transcribe_chunk, chunk_paths, TRANSCRIPTION_CHUNK_CONCURRENCY))
+
+async def create_transcription(openai_client: AsyncOpenAI, audio, audio_extension: str, mime_type: str) -> str:
+    """Sends one audio file (file-like or bytes) to Whisper and returns the text."""
+    transcription_response = await openai_client.audio.transcriptions.create(
+        model="whisper-1",
+        # The filename extension tells OpenAI which decoder to use
+        file=(f"audio.{audio_extension}", audio, mime_type), # filename, file, mimetype
+        language="en",
+        temperature=0.5
+    )
+    return transcription_response.text
+
+async def run_command(*args: str):
+    """Runs a command without blocking the event loop and returns (returncode, stdout, stderr)."""
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    return process.returncode, stdout.decode(), stderr.decode()
+
+async def probe_audio_duration(path: str):
+    """Returns the duration of an audio file in seconds, or None if ffprobe can't tell."""
+    returncode, stdout, stderr = await run_command(
+        "ffprobe", "-v", "error", "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1", path
+    )
+    try:
+        if returncode != 0:
+            raise ValueError(stderr.strip())
+        return float(stdout.strip())
+    except ValueError as e:
+        logging.warning(f"Could not determine audio duration, transcribing without chunking: {e}")
+        return None
+
+async def split_audio(source_path: str, work_dir: str, audio_extension: str) -> list:
+    """
+    Splits an audio file into TRANSCRIPTION_CHUNK_SECONDS segments without
+    re-encoding and returns the chunk paths in order, or [] if ffmpeg fails.
+    """
+    chunk_pattern = os.path.join(work_dir, f"chunk_%03d.{audio_extension}")
+    returncode, _, stderr = await run_command(
+        "ffmpeg", "-v", "error", "-i", source_path, "-f", "segment",
+        "-segment_time", str(TRANSCRIPTION_CHUNK_SECONDS), "-reset_timestamps", "1",
+        "-c", "copy", chunk_pattern
+    )
+    if returncode != 0:
+        logging.warning(f"Could not split audio, transcribing without chunking: {stderr}")
+        return []
+    return sorted(
+        os.path.join(work_dir, name) for name in os.listdir(work_dir) if name.startswith("chunk_")
+    )
+
+async def send_recording_callback(pending_callback: dict):
+    """
+    Sends a processed recording's transcript back to the PropEquity API (step 6.10)
+    and returns the row to upsert into Supabase, or None if the callback failed.
+    """
+    file_id = pending_callback["file_id"]
+    project_id = pending_callback["project_id"]
 
-"Configuration": List BHK types mentioned like "2,3".
+    try:
+        # 6.10. Send data back to PropEquity API (sendback-data-fromDB_direct)
+        send_data_url = f"{PROPEQUITY_API_BASE_URL}/create-recording-transcript"
+        send_payload = {
+            "fileId": file_id,
+            "projectId": project_id,
+            "transcriptData": pending_callback["transcriptData"], # This should be the stringified JSON
+            "status": "1"
+        }
+        send_response = await get_http_client().post(send_data_url, json=send_payload)
+        send_response.raise_for_status()
+        logging.info(f"Sent data back to PropEquity API for {file_id}.")
 
-"Completion_Date": Mention project completion time or say "Ready to Move" if completed.
+        return {
+            "file_id": file_id,
+            "callback_response": send_response.json() # Store the response from the API
+        }
 
-"Additional_Notes": Expert summary of the whole transcript. This should include everything that was contained in the call.
+    except httpx.HTTPError as e:
+        error_message = f"HTTP Request Error for {file_id}: {e}"
+        logging.error(error_message)
+        await handle_processing_error(file_id, project_id, error_message)
+    except Exception as e:
+        error_message = f"General processing error for {file_id}: {e}"
+        logging.error(error_message, exc_info=True)
+        await handle_processing_error(file_id, project_id, error_message)
 
-"Notes": give response in one word, if the developer asked to call back or asks to connect with someone else by sharing a mobile number, mention as 'Call back', if wrong number was dialled then mention as 'Wrong number' or if the call went to voice mail or any automated answering machine, then mention as 'Voicemail'.if the information regarding the type of configuration, price and area of each configuration, total number of units the project will have and the units still available and/or total number of units sold so far has been provied, record response as 'Successful'.There is an exception for successful calls. If the developer does not give any information and tells the project is sold out or there is no units available for sale, such calls too should be labeled as 'Successful' If  the information of total number of units still available or total number of units sold so far is available  and price of units is available then label them as 'Successful (absorption)', if all the information is available except either the information of total number of units still available for sale or total number of units sold so far, then label them as 'Partial', please be aware that developer might either say 90% sold or 90% available, this means if there are 100 total units the 90% or 90 units are sold or 90 are still available out of 100 for sale.A call should be labelled as 'Unsuccessful' if there is no information available regarding total units that be there in the project, price of unit and  and how many units have been sold so far or are still available. ."""
-
-            chat_completion = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                response_format={"type": "json_object"} # Request JSON output
-            )
-            # Let's get the content, then stringify it twice.
-            summary_content_str = chat_completion.choices[0].message.content
-            # Ensure it's valid JSON before double stringifying
-            try:
-                summary_json_obj = json.loads(summary_content_str)
-                double_stringified_summary = json.dumps(json.dumps(summary_json_obj))
-            except json.JSONDecodeError:
-                logging.error(f"OpenAI did not return valid JSON for {file_id}. Raw content: {summary_content_str}")
-                double_stringified_summary = json.dumps(summary_content_str) # Store as is if not valid JSON
-
-            logging.info(f"Summarized call for {file_id}.")
-
-            # 6.9. Update Supabase with transcriptData (updatewithcallresponse_direct2)
-            supabase.table(SUPABASE_TABLE_NAME).update({
-                "transcriptData": double_stringified_summary
-            }).eq("file_id", file_id).execute()
-            logging.info(f"Updated transcriptData for {file_id} in Supabase.")
-
-            # 6.10. Send data back to PropEquity API (sendback-data-fromDB_direct)
+async def handle_processing_error(file_id: str, project_id: str, error_details: str):
+    """
+    Handles errors during the processing of a single file, updating Supabase and
+    sending error info back to the PropEquity API.
+    """
+    logging.info(f"Handling error for file_id: {file_id}")
+    supabase = await get_supabase_client()
+    try:
+        error_transcript_data = orjson.dumps({"error": error_details}).decode() # Error as JSON string
+        error_update = {"transcriptData": error_transcript_data}
+        try:
+            # Send error back to PropEquity API (sendback-data-fromDB_direct2)
             send_data_url = f"{PROPEQUITY_API_BASE_URL}/create-recording-transcript"
-            payload_transcript_data = json.loads(double_stringified_summary) # This is the stringified JSON
             send_payload = {
                 "fileId": file_id,
                 "projectId": project_id,
-                "transcriptData": payload_transcript_data, # This should be the stringified JSON
-                "status": "1"
+                "transcriptData": error_transcript_data, # Send error as stringified JSON
+                "status": "0" # Assuming '0' indicates an error status
             }
-            send_response = requests.post(send_data_url, json=send_payload)
+            send_response = await get_http_client().post(send_data_url, json=send_payload)
             send_response.raise_for_status()
-            logging.info(f"Sent data back to PropEquity API for {file_id}.")
-
-            # 6.11. Update Supabase with callback response (updatewithcallresponse_direct)
-            supabase.table(SUPABASE_TABLE_NAME).update({
-                "callback_response": send_response.json() # Store the response from the API
-            }).eq("file_id", file_id).execute()
-            logging.info(f"Updated callback_response for {file_id} in Supabase.")
-
-        except requests.exceptions.RequestException as e:
-            error_message = f"HTTP Request Error for {file_id}: {e}"
-            logging.error(error_message)
-            # Error reporting path (error reporting & sendback-data-fromDB_direct2)
-            handle_processing_error(file_id, project_id, error_message)
-        except OpenAI.APIError as e:
-            error_message = f"OpenAI API Error for {file_id}: {e}"
-            logging.error(error_message)
-            handle_processing_error(file_id, project_id, error_message)
-        except Exception as e:
-            error_message = f"General processing error for {file_id}: {e}"
-            logging.error(error_message, exc_info=True) # Log traceback for general errors
-            handle_processing_error(file_id, project_id, error_message)
+            error_update["callback_response"] = send_response.json()
+            logging.info(f"Sent error data back to PropEquity API for {file_id}.")
+        finally:
+            # Update Supabase with error and callback response in one call
+            # (error reporting & updatewithcallresponse_direct). Runs even if the
+            # callback failed so the error is still recorded.
+            await supabase.table(SUPABASE_TABLE_NAME).update(error_update).eq("file_id", file_id).execute()
+            logging.info(f"Updated Supabase with error details for {file_id}.")
 
-    logging.info("PropE_Transcriber workflow completed.")
+    except Exception as e:
+        logging.error(f"Critical error during error handling for {file_id}: {e}", exc_info=True)
 
-def handle_processing_error(file_id: str, project_id: str, error_details: str):
+async def close_clients():
     """
-    Handles errors during the processing of a single file, updating Supabase and
-    sending error info back to the PropEquity API.
+    Closes the pooled connections of the shared clients before the event loop
+    shuts down. Clients that were never created are left alone rather than being
+    built just to be closed.
     """
-    logging.info(f"Handling error for file_id: {file_id}")
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+    if get_openai_client.cache_info().currsize:
+        await get_openai_client().close()
+    if _supabase_client is not None:
+        # Relies on the supabase 2.10 AsyncClient layout: the gotrue auth client is
+        # created eagerly with its own httpx session, while the postgrest and storage
+        # properties build their clients on first access, so only the ones already
+        # created are closed. Functions is never used here and realtime opens no
+        # connection until a channel subscribes.
+        await _supabase_client.auth.close()
+        if _supabase_client._postgrest is not None:
+            await _supabase_client._postgrest.aclose()
+        if _supabase_client._storage is not None:
+            await _supabase_client._storage.aclose()
+
+async def main():
     try:
-        # Update Supabase with error (error reporting)
-        supabase.table(SUPABASE_TABLE_NAME).update({
-            "transcriptData": json.dumps({"error": error_details}) # Store error as JSON string
-        }).eq("file_id", file_id).execute()
-        logging.info(f"Updated Supabase with error for {file_id}.")
-
-        # Send error back to PropEquity API (sendback-data-fromDB_direct2)
-        send_data_url = f"{PROPEQUITY_API_BASE_URL}/create-recording-transcript"
-        send_payload = {
-            "fileId": file_id,
-            "projectId": project_id,
-            "transcriptData": json.dumps({"error": error_details}), # Send error as stringified JSON
-            "status": "0" # Assuming '0' indicates an error status
-        }
-        send_response = requests.post(send_data_url, json=send_payload)
-        send_response.raise_for_status()
-        logging.info(f"Sent error data back to PropEquity API for {file_id}.")
-
-        # Update Supabase with callback response (updatewithcallresponse_direct)
-        supabase.table(SUPABASE_TABLE_NAME).update({
-            "callback_response": send_response.json()
-        }).eq("file_id", file_id).execute()
-        logging.info(f"Updated callback_response with error details for {file_id} in Supabase.")
-
-    except Exception as e:
-        logging.error(f"Critical error during error handling for {file_id}: {e}", exc_info=True)
+        await run_transcriber_workflow()
+    finally:
+        await close_clients()
 
 if __name__ == "__main__":
-    run_transcriber_workflow()
+    asyncio.run(main())